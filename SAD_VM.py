@@ -3,8 +3,9 @@
 # Author: Kristopher J. Carroll
 # Description: 
 #   SAD (Simple and Dumb) VM is a simulated machine featuring a 32-bit RISC
-#   instruction set architecture. It has 16 accessible registers including a program
-#   counter, dedicated count register, and 14 general-use registers. Additionally,
+#   instruction set architecture. It has 16 registers: a program counter, which is
+#   only changed by the jump instructions and cannot be used as an operand, a
+#   dedicated count register, and 14 general-use registers. Additionally,
 #   it has two inaccessible registers, a conditional flag register for use with
 #   boolean expressions and conditional jump statements as well as a return address
 #   register that is automatically set with the JMPR (jump and return) instruction
@@ -18,12 +19,22 @@
 #   Although the instruction set was designed as a fixed-width RISC style, the current
 #   implementation does not enforce this width. However, all operations of the machine
 #   expect to find instructions according to their proper format.
+#   Once loaded, a program is held as threaded code, one (handler, instruction tuple)
+#   pair per address, so fetching an instruction is a single list read and unpack.
+#   The tuples are left at their natural length rather than padded to the fixed width,
+#   since each handler only indexes the operands it uses.
 #
 #   Instructions for a small subset of the Pascal programming language can be compiled
 #   for pasting directly into SAD_VM.py with the use of the pascal.l, pascal.y and AST.h
 #   files found in this repository, which can be built with the included MAKEFILE.
+#
+#   The VM is written in plain Python with no C extension dependencies, so it runs
+#   unchanged under PyPy (pypy3 SAD_VM.py), whose tracing JIT handles the dispatch
+#   loop in run() far better than CPython does.
 ######################################################################################
 
+import sys
+
 
 # op codes
 MOV = 0x0
@@ -43,6 +54,40 @@ INC = 0xd
 DEC = 0xe
 STCK = 0xf
 
+# fused op codes, each doing the work of a common run of instructions in one step
+PRINT_STACK_LOOP = 0x10 # STCK POP / MEM STOR to IO_CHAR / LOOP, without keeping the popped value
+DIVMODI = 0x11 # quotient and remainder of a register by an immediate, in place of MATH DIV / MULT / SUB
+XOFF = 0x13 # clears flag memory bits start, start + step, ... below end, all three given in registers
+
+# stops the machine; Machine.load() appends one to every program and points jumps
+# to a None target at it
+HALT = 0x1f
+
+# specialised op codes, produced by Machine.load() from the mode flag of the
+# instructions above so that no handler has to branch on a mode at run time
+MEM_LOAD = 0x20
+MEM_STOR = 0x21
+MEM_LOAD_IO = 0x22 # MEM LOAD from IO_IN
+MEM_STOR_INT = 0x23 # MEM STOR to IO_OUT
+MEM_STOR_CHAR = 0x24 # MEM STOR to IO_CHAR
+MEM_BLOAD = 0x26
+MEM_BSTOR = 0x27
+MATH_ADD = 0x30
+MATH_SUB = 0x31
+MATH_MULT = 0x32
+MATH_DIV = 0x33
+MATHI_ADD = 0x34
+MATHI_SUB = 0x35
+MATHI_MULT = 0x36
+MATHI_DIV = 0x37
+COMP_EQ = 0x38
+COMP_NEQ = 0x39
+COMP_LT = 0x3a
+COMP_GT = 0x3b
+COMP_LTE = 0x3c
+COMP_GTE = 0x3d
+STCK_PUSH = 0x3e
+STCK_POP = 0x3f
 
 # math ops
 ADD = 0x0
@@ -53,6 +98,8 @@ DIV = 0x3
 # mem ops
 LOAD = 0x0
 STOR = 0x1
+BLOAD = 0x2 # load from the bit-packed flag memory
+BSTOR = 0x3 # store to the bit-packed flag memory
 # stack ops
 PUSH = 0x0
 POP = 0x1
@@ -65,7 +112,7 @@ GT = 0x3
 LTE = 0x4
 GTE = 0x5
 
-# accessible registers
+# registers (PC is not accessible as an operand)
 PC = 0x0
 R_CNT = 0x1
 R_0 = 0x2
@@ -83,220 +130,627 @@ R_11 = 0xd
 R_12 = 0xe
 R_13 = 0xf
 
-IO_OUT = 0xffff0000
+# memory mapped IO addresses
+IO_IN = 0xff00 # loading reads an integer from stdin
+IO_OUT = 0xffff0000 # storing prints an integer
+IO_CHAR = 0xffff0001 # storing prints a character, or a newline for 0
+
+# op code -> (position of mode flag, mode flag -> specialised op code)
+SPECIALIZE = {
+    MEM: (3, {LOAD: MEM_LOAD, STOR: MEM_STOR, BLOAD: MEM_BLOAD, BSTOR: MEM_BSTOR}),
+    MATH: (4, {ADD: MATH_ADD, SUB: MATH_SUB, MULT: MATH_MULT, DIV: MATH_DIV}),
+    MATHI: (2, {ADD: MATHI_ADD, SUB: MATHI_SUB, MULT: MATHI_MULT, DIV: MATHI_DIV}),
+    COMP: (3, {EQ: COMP_EQ, NEQ: COMP_NEQ, LT: COMP_LT, GT: COMP_GT, LTE: COMP_LTE, GTE: COMP_GTE}),
+    STCK: (2, {PUSH: STCK_PUSH, POP: STCK_POP}),
+}
+
+# op code -> positions of its register operands, checked by Machine.load()
+REGISTER_OPERANDS = {
+    MOV: (1, 2), LIMM: (1,), INC: (1,), DEC: (1,),
+    MEM_LOAD: (1, 2), MEM_STOR: (1, 2), MEM_LOAD_IO: (1,), MEM_STOR_INT: (1,), MEM_STOR_CHAR: (1,),
+    MEM_BLOAD: (1, 2), MEM_BSTOR: (1, 2),
+    MATH_ADD: (1, 2, 3), MATH_SUB: (1, 2, 3), MATH_MULT: (1, 2, 3), MATH_DIV: (1, 2, 3),
+    MATHI_ADD: (1,), MATHI_SUB: (1,), MATHI_MULT: (1,), MATHI_DIV: (1,),
+    COMP_EQ: (1, 2), COMP_NEQ: (1, 2), COMP_LT: (1, 2), COMP_GT: (1, 2), COMP_LTE: (1, 2), COMP_GTE: (1, 2),
+    STCK_PUSH: (1,), STCK_POP: (1,),
+    DIVMODI: (1, 2, 3), XOFF: (1, 2, 3),
+}
+
+# op codes that choose the next pc themselves -> position of their jump target operand
+BRANCHES = {JMP: 1, JMPC: 1, JMPR: 1, RET: None, LOOP: 1, PRINT_STACK_LOOP: 1, HALT: None}
+
+
+class Halt(Exception):
+    # raised by the HALT handler to leave run()'s loop, caught outside of it
+    pass
+
 
 class Machine:
-    def __init__(self, prog):
-        self.program = prog # program instructions as an array of tuples
+    # fixed machine state, stored in slots rather than a per-instance dict
+    __slots__ = ('cond', 'ra', 'regs', 'stack', 'sp', 'mem', 'bits', 'out', 'ops', 'program', 'code', 'compiled')
+
+    def __init__(self, prog, mem_size=1 << 16, stack_size=1024, bits_size=1 << 16):
         self.cond = 0 # conditional register
         self.ra = 0 # return address register
-        self.regs = {i: 0 for i in range(16)} # registers: 0 is PC, 1 is CNT
-        self.stack = [] # blank stack
-        self.mem = {} # data memory
-        self.ops = {
-            MOV: self.mov_op,
-            MEM: self.mem_op,
-            LIMM: self.limm_op,
-            MATH: self.math_op,
-            MATHI: self.mathi_op,
-            COMP: self.comp_op,
-            CNT: self.cnt_op,
-            LOOP: self.loop_op,
-            JMP: self.jmp_op,
-            JMPC: self.jmpc_op,
-            JMPR: self.jmpr_op,
-            RET: self.ret_op,
-            INC: self.inc_op,
-            DEC: self.dec_op,
-            STCK: self.stck_op,
-        }
-
-    def mov_op(self, rest):
-        dst = rest[0]
-        src = rest[1]
+        self.regs = [0] * 16 # registers: 0 is PC, 1 is CNT
+        self.stack = [0] * stack_size # blank stack, preallocated
+        self.sp = 0 # stack pointer, index of the next free slot
+        self.mem = [0] * mem_size # data memory, preallocated and addressed by integer
+        self.bits = bytearray(bits_size >> 3) # flag memory, one bit per address
+        self.out = [] # characters printed since the last newline, written out by flush()
+        # dispatch table of plain functions indexed directly by op code, each called
+        # with the machine, the full instruction tuple and the next pc (LOG is not implemented)
+        self.ops = [None] * 64
+        self.ops[MOV] = Machine.mov_op
+        self.ops[LIMM] = Machine.limm_op
+        self.ops[CNT] = Machine.cnt_op
+        self.ops[LOOP] = Machine.loop_op
+        self.ops[JMP] = Machine.jmp_op
+        self.ops[JMPC] = Machine.jmpc_op
+        self.ops[JMPR] = Machine.jmpr_op
+        self.ops[RET] = Machine.ret_op
+        self.ops[INC] = Machine.inc_op
+        self.ops[DEC] = Machine.dec_op
+        self.ops[MEM_LOAD] = Machine.mem_load
+        self.ops[MEM_STOR] = Machine.mem_stor
+        self.ops[MEM_LOAD_IO] = Machine.mem_load_io
+        self.ops[MEM_STOR_INT] = Machine.mem_stor_int
+        self.ops[MEM_STOR_CHAR] = Machine.mem_stor_char
+        self.ops[MEM_BLOAD] = Machine.mem_bload
+        self.ops[MEM_BSTOR] = Machine.mem_bstor
+        self.ops[MATH_ADD] = Machine.math_add
+        self.ops[MATH_SUB] = Machine.math_sub
+        self.ops[MATH_MULT] = Machine.math_mult
+        self.ops[MATH_DIV] = Machine.math_div
+        self.ops[MATHI_ADD] = Machine.mathi_add
+        self.ops[MATHI_SUB] = Machine.mathi_sub
+        self.ops[MATHI_MULT] = Machine.mathi_mult
+        self.ops[MATHI_DIV] = Machine.mathi_div
+        self.ops[COMP_EQ] = Machine.comp_eq
+        self.ops[COMP_NEQ] = Machine.comp_neq
+        self.ops[COMP_LT] = Machine.comp_lt
+        self.ops[COMP_GT] = Machine.comp_gt
+        self.ops[COMP_LTE] = Machine.comp_lte
+        self.ops[COMP_GTE] = Machine.comp_gte
+        self.ops[STCK_PUSH] = Machine.stck_push
+        self.ops[STCK_POP] = Machine.stck_pop
+        self.ops[PRINT_STACK_LOOP] = Machine.print_stack_loop
+        self.ops[DIVMODI] = Machine.divmodi_op
+        self.ops[XOFF] = Machine.xoff_op
+        self.ops[HALT] = Machine.halt_op
+        self.program = self.load(prog) # program instructions as an array of tuples
+        # threaded code: each instruction paired with its handler, resolved once here so
+        # run() only has to call it. Handlers take the address of the following
+        # instruction and return the address to continue from
+        self.code = [(self.ops[instruct[0]], instruct) for instruct in self.program]
+        self.compiled = None # function generated by compile_prog(), built on first run_compiled()
+
+    def load(self, prog):
+        # lowers the program into an immutable list of tuples, rewriting moded
+        # instructions into their specialised op codes and checking every op code
+        # against the dispatch table up front so run() never has to
+        program = []
+        for addr, instruct in enumerate(prog):
+            instruct = tuple(instruct)
+            op = instruct[0]
+            if op in SPECIALIZE:
+                pos, modes = SPECIALIZE[op]
+                if instruct[pos] not in modes:
+                    print("ERROR(load): mode flag {} not found for op code {} at address {}".format(instruct[pos], op, addr))
+                    quit()
+                instruct = (modes[instruct[pos]],) + instruct[1:pos] + instruct[pos + 1:]
+                op = instruct[0]
+            # the IO addresses are constant operands, so accesses to them get op codes of their own
+            if op == MEM_LOAD and instruct[2] == IO_IN:
+                instruct = (MEM_LOAD_IO, instruct[1])
+            elif op == MEM_STOR and instruct[1] == IO_OUT:
+                instruct = (MEM_STOR_INT, instruct[2])
+            elif op == MEM_STOR and instruct[1] == IO_CHAR:
+                instruct = (MEM_STOR_CHAR, instruct[2])
+            op = instruct[0]
+            if not 0 <= op < len(self.ops) or self.ops[op] is None:
+                print("ERROR(load): unknown op code {} at address {}".format(op, addr))
+                quit()
+            # the pc is kept in a local by run() and compiled code, so it can only be
+            # changed by the jump op codes and never read or written as a register
+            if any(instruct[pos] == PC for pos in REGISTER_OPERANDS.get(op, ())):
+                print("ERROR(load): PC used as a register operand at address {}".format(addr))
+                quit()
+            program.append(instruct)
+
+        # running off the end of the program lands on a HALT, and a None jump target
+        # becomes a jump to it; every other target has to be an address in the program
+        halt = len(program)
+        program.append((HALT,))
+        for addr, instruct in enumerate(program):
+            pos = BRANCHES.get(instruct[0])
+            if pos is None:
+                continue
+            target = instruct[pos]
+            if target is None:
+                program[addr] = instruct[:pos] + (halt,) + instruct[pos + 1:]
+            elif not isinstance(target, int) or not 0 <= target <= halt:
+                print("ERROR(load): jump target {} out of range at address {}".format(target, addr))
+                quit()
+        return program
+
+    def mov_op(self, instruct, pc):
+        dst = instruct[1]
+        src = instruct[2]
         self.regs[dst] = self.regs[src]
+        return pc
+
+    def math_add(self, instruct, pc):
+        self.regs[instruct[1]] = self.regs[instruct[2]] + self.regs[instruct[3]]
+        return pc
 
-    def math_op(self, rest):
-        dst = rest[0]
-        src1 = rest[1]
-        src2 = rest[2]
-        mode = rest[3]
-        if mode == ADD: # add
-            self.regs[dst] = self.regs[src1] + self.regs[src2]
-        elif mode == SUB: # sub
-            self.regs[dst] = self.regs[src1] - self.regs[src2]
-        elif mode == MULT: # mult
-            self.regs[dst] = self.regs[src1] * self.regs[src2]
-        elif mode == DIV: # div
-            self.regs[dst] = self.regs[src1] // self.regs[src2]
+    def math_sub(self, instruct, pc):
+        self.regs[instruct[1]] = self.regs[instruct[2]] - self.regs[instruct[3]]
+        return pc
+
+    def math_mult(self, instruct, pc):
+        self.regs[instruct[1]] = self.regs[instruct[2]] * self.regs[instruct[3]]
+        return pc
+
+    def math_div(self, instruct, pc):
+        self.regs[instruct[1]] = self.regs[instruct[2]] // self.regs[instruct[3]]
+        return pc
+
+    def mathi_add(self, instruct, pc):
+        self.regs[instruct[1]] += instruct[2]
+        return pc
+
+    def mathi_sub(self, instruct, pc):
+        self.regs[instruct[1]] -= instruct[2]
+        return pc
+
+    def mathi_mult(self, instruct, pc):
+        self.regs[instruct[1]] *= instruct[2]
+        return pc
+
+    def mathi_div(self, instruct, pc):
+        self.regs[instruct[1]] //= instruct[2]
+        return pc
+
+    def mem_load(self, instruct, pc):
+        addr = self.regs[instruct[2]]
+        if not 0 <= addr < len(self.mem):
+            self.error("mem_load", "address {} out of range".format(addr))
+        self.regs[instruct[1]] = self.mem[addr]
+        return pc
+
+    def mem_stor(self, instruct, pc):
+        addr = self.regs[instruct[1]]
+        if not 0 <= addr < len(self.mem):
+            self.error("mem_stor", "address {} out of range".format(addr))
+        self.mem[addr] = self.regs[instruct[2]]
+        return pc
+
+    def mem_load_io(self, instruct, pc):
+        self.flush()
+        self.regs[instruct[1]] = int(input())
+        return pc
+
+    def mem_stor_int(self, instruct, pc):
+        self.flush(str(self.regs[instruct[1]]) + '\n')
+        return pc
+
+    def mem_stor_char(self, instruct, pc):
+        if self.regs[instruct[1]] == 0:
+            self.flush('\n')
         else:
-            print("ERROR(math_op): math mode flag not found")
-            quit()
-    
-    def mathi_op(self, rest):
-        dst = rest[0]
-        mode = rest[1]
-        imm = rest[2]
-        if mode == ADD: # add
-            self.regs[dst] += imm
-        elif mode == SUB: # sub
-            self.regs[dst] -= imm
-        elif mode == MULT: # mult
-            self.regs[dst] *= imm
-        elif mode == DIV: # div
-            self.regs[dst] //= imm
+            self.out.append(chr(self.regs[instruct[1]]))
+        return pc
+
+    def flush(self, end=''):
+        # characters are buffered until a newline so output is written a line at a time
+        sys.stdout.write(''.join(self.out) + end)
+        self.out.clear()
+
+    def error(self, where, message):
+        # pending output is written first so the error appears after it
+        self.flush()
+        print("ERROR({}): {}".format(where, message))
+        quit()
+
+    def mem_bload(self, instruct, pc):
+        addr = self.regs[instruct[2]]
+        if not 0 <= addr < len(self.bits) << 3:
+            self.error("mem_bload", "address {} out of range".format(addr))
+        self.regs[instruct[1]] = self.bits[addr >> 3] >> (addr & 7) & 1
+        return pc
+
+    def mem_bstor(self, instruct, pc):
+        addr = self.regs[instruct[1]]
+        if not 0 <= addr < len(self.bits) << 3:
+            self.error("mem_bstor", "address {} out of range".format(addr))
+        if self.regs[instruct[2]]:
+            self.bits[addr >> 3] |= 1 << (addr & 7)
         else:
-            print("ERROR(mathi_op): math mode flag not found ({})".format(mode))
-            quit()
-    
-    def mem_op(self, rest):
-        dst = rest[0]
-        src = rest[1]
-        mode = rest[2]
-        if mode == LOAD:
-            if src == 0xff00:
-                self.regs[dst] = int(input())
-            else:
-                self.regs[dst] = self.mem[self.regs[src]]
-        elif mode == STOR:
-            if dst == 0xffff0000:
-                print(self.regs[src])
-                return
-            if dst == 0xffff0001:
-                if self.regs[src] == 0:
-                    print()
-                else:
-                    print(chr(self.regs[src]), end='')
-            else:
-                self.mem[self.regs[dst]] = self.regs[src]
+            self.bits[addr >> 3] &= ~(1 << (addr & 7))
+        return pc
 
-    def limm_op(self, rest):
-        dst = rest[0]
-        self.regs[dst] = rest[1]
+    def limm_op(self, instruct, pc):
+        dst = instruct[1]
+        self.regs[dst] = instruct[2]
+        return pc
     
-    def jmp_op(self, rest):
-        self.regs[PC] = rest[0]
+    def jmp_op(self, instruct, pc):
+        return instruct[1]
     
-    def jmpc_op(self, rest):
-        if not self.cond:
-            self.regs[PC] = rest[0]
+    def jmpc_op(self, instruct, pc):
+        # falling through is the common case (about 70% in the sieve), so test it first
+        if self.cond:
+            return pc
+        return instruct[1]
     
-    def jmpr_op(self, rest):
-        self.ra = self.regs[PC]
-        self.regs[PC] = rest[0]
+    def jmpr_op(self, instruct, pc):
+        self.ra = pc
+        return instruct[1]
     
-    def ret_op(self, rest):
-        self.regs[PC] = self.ra
+    def ret_op(self, instruct, pc):
+        return self.ra
             
-    def comp_op(self, rest):
-        reg1 = rest[0]
-        reg2 = rest[1]
-        mode = rest[2]
-        if mode == EQ:
-            self.cond = int(self.regs[reg1] == self.regs[reg2])
-        elif mode == NEQ:
-            self.cond = int(self.regs[reg1] != self.regs[reg2])
-        elif mode == LT:
-            self.cond = int(self.regs[reg1] < self.regs[reg2])
-        elif mode == GT:
-            self.cond = int(self.regs[reg1] > self.regs[reg2])
-        elif mode == LTE:
-            self.cond = int(self.regs[reg1] <= self.regs[reg2])
-        elif mode == GTE:
-            self.cond = int(self.regs[reg1] >= self.regs[reg2])
-        else:
-            print("ERROR(comp_op): comparison mode flag not found.")
-            quit()
+    def comp_eq(self, instruct, pc):
+        self.cond = int(self.regs[instruct[1]] == self.regs[instruct[2]])
+        return pc
+
+    def comp_neq(self, instruct, pc):
+        self.cond = int(self.regs[instruct[1]] != self.regs[instruct[2]])
+        return pc
+
+    def comp_lt(self, instruct, pc):
+        self.cond = int(self.regs[instruct[1]] < self.regs[instruct[2]])
+        return pc
+
+    def comp_gt(self, instruct, pc):
+        self.cond = int(self.regs[instruct[1]] > self.regs[instruct[2]])
+        return pc
+
+    def comp_lte(self, instruct, pc):
+        self.cond = int(self.regs[instruct[1]] <= self.regs[instruct[2]])
+        return pc
+
+    def comp_gte(self, instruct, pc):
+        self.cond = int(self.regs[instruct[1]] >= self.regs[instruct[2]])
+        return pc
         
-    def cnt_op(self, rest):
-        self.regs[R_CNT] = rest[0]
+    def cnt_op(self, instruct, pc):
+        self.regs[R_CNT] = instruct[1]
+        return pc
 
-    def loop_op(self, rest):
+    def loop_op(self, instruct, pc):
         self.regs[R_CNT] -= 1
         if self.regs[R_CNT]:
-            self.regs[PC] = rest[0]
+            return instruct[1]
+        return pc
     
-    def inc_op(self, rest):
-        self.regs[rest[0]] += 1
+    def inc_op(self, instruct, pc):
+        self.regs[instruct[1]] += 1
+        return pc
     
-    def dec_op(self, rest):
-        self.regs[rest[0]] -= 1
+    def dec_op(self, instruct, pc):
+        self.regs[instruct[1]] -= 1
+        return pc
     
-    def stck_op(self, rest):
-        reg = rest[0]
-        mode = rest[1]
-        if mode == PUSH:
-            self.stack.append(self.regs[reg])
-        elif mode == POP:
-            self.regs[reg] = self.stack.pop()
+    def stck_push(self, instruct, pc):
+        sp = self.sp
+        if sp == len(self.stack):
+            self.error("stck_push", "stack overflow")
+        self.stack[sp] = self.regs[instruct[1]]
+        self.sp = sp + 1
+        return pc
+
+    def stck_pop(self, instruct, pc):
+        if self.sp == 0:
+            self.error("stck_pop", "stack underflow")
+        sp = self.sp - 1
+        self.sp = sp
+        self.regs[instruct[1]] = self.stack[sp]
+        return pc
+
+    def print_stack_loop(self, instruct, pc):
+        if self.sp == 0:
+            self.error("print_stack_loop", "stack underflow")
+        sp = self.sp - 1
+        self.sp = sp
+        value = self.stack[sp]
+        if value:
+            self.out.append(chr(value))
+        else:
+            self.flush('\n')
+        regs = self.regs
+        regs[R_CNT] -= 1
+        if regs[R_CNT]:
+            return instruct[1]
+        return pc
+
+    def divmodi_op(self, instruct, pc):
+        q, r = divmod(self.regs[instruct[3]], instruct[4])
+        self.regs[instruct[1]] = q
+        self.regs[instruct[2]] = r
+        return pc
+
+    def xoff_op(self, instruct, pc):
+        # the whole strided cross-off of a sieve runs here instead of as a loop of
+        # VM instructions
+        bits = self.bits
+        start = self.regs[instruct[1]]
+        step = self.regs[instruct[2]]
+        end = self.regs[instruct[3]]
+        if step <= 0:
+            self.error("xoff_op", "step {} is not positive".format(step))
+        if start < 0 or end < 0:
+            self.error("xoff_op", "negative address {}".format(min(start, end)))
+        if end > len(bits) << 3:
+            self.error("xoff_op", "address {} out of range".format(end))
+        for addr in range(start, end, step):
+            bits[addr >> 3] &= ~(1 << (addr & 7))
+        return pc
+
+    def halt_op(self, instruct, pc):
+        raise Halt
 
     def run(self):
+        # handlers are called rather than inlined into an if/elif chain on the op code:
+        # the chain of comparisons costs more than the call it saves on CPython 3.11+.
+        # For a fully inlined loop over local state use run_compiled()
+        regs = self.regs
+        code = self.code
+        pc = regs[PC]
         try:
-            while self.regs[PC] is not None:
-                instruct = self.program[self.regs[PC]]
-                self.regs[PC] += 1
-                op = instruct[0]
-                rest = instruct[1:]
-                self.ops[op](rest)
-        except IndexError:
+            while True:
+                handler, instruct = code[pc]
+                pc = handler(self, instruct, pc + 1)
+        except Halt:
             return 0
-    
+        finally:
+            regs[PC] = pc
+            self.flush()
+
+    def run_compiled(self):
+        if self.compiled is None:
+            self.compiled = compile_prog(self.program)
+        return self.compiled(self)
+
+
+# python source for each straight-line op code, formatted with the instruction's operands
+SOURCE = {
+    MOV: "regs[{0}] = regs[{1}]",
+    LIMM: "regs[{0}] = {1}",
+    CNT: "regs[R_CNT] = {0}",
+    INC: "regs[{0}] += 1",
+    DEC: "regs[{0}] -= 1",
+    MATH_ADD: "regs[{0}] = regs[{1}] + regs[{2}]",
+    MATH_SUB: "regs[{0}] = regs[{1}] - regs[{2}]",
+    MATH_MULT: "regs[{0}] = regs[{1}] * regs[{2}]",
+    MATH_DIV: "regs[{0}] = regs[{1}] // regs[{2}]",
+    MATHI_ADD: "regs[{0}] += {1}",
+    MATHI_SUB: "regs[{0}] -= {1}",
+    MATHI_MULT: "regs[{0}] *= {1}",
+    MATHI_DIV: "regs[{0}] //= {1}",
+    COMP_EQ: "cond = int(regs[{0}] == regs[{1}])",
+    COMP_NEQ: "cond = int(regs[{0}] != regs[{1}])",
+    COMP_LT: "cond = int(regs[{0}] < regs[{1}])",
+    COMP_GT: "cond = int(regs[{0}] > regs[{1}])",
+    COMP_LTE: "cond = int(regs[{0}] <= regs[{1}])",
+    COMP_GTE: "cond = int(regs[{0}] >= regs[{1}])",
+    STCK_PUSH: "if sp == len(stack):\n    machine.error('stck_push', 'stack overflow')\nstack[sp] = regs[{0}]\nsp += 1",
+    STCK_POP: "if sp == 0:\n    machine.error('stck_pop', 'stack underflow')\nsp -= 1\nregs[{0}] = stack[sp]",
+    MEM_LOAD: "if not 0 <= regs[{1}] < len(mem):\n    machine.error('mem_load', 'address ' + str(regs[{1}]) + ' out of range')\nregs[{0}] = mem[regs[{1}]]",
+    MEM_STOR: "if not 0 <= regs[{0}] < len(mem):\n    machine.error('mem_stor', 'address ' + str(regs[{0}]) + ' out of range')\nmem[regs[{0}]] = regs[{1}]",
+    MEM_LOAD_IO: "flush()\nregs[{0}] = int(input())",
+    MEM_STOR_INT: "flush(str(regs[{0}]) + '\\n')",
+    MEM_STOR_CHAR: "if regs[{0}] == 0:\n    flush('\\n')\nelse:\n    out_append(chr(regs[{0}]))",
+    MEM_BLOAD: "if not 0 <= regs[{1}] < len(bits) << 3:\n    machine.error('mem_bload', 'address ' + str(regs[{1}]) + ' out of range')\nregs[{0}] = bits[regs[{1}] >> 3] >> (regs[{1}] & 7) & 1",
+    MEM_BSTOR: "if not 0 <= regs[{0}] < len(bits) << 3:\n    machine.error('mem_bstor', 'address ' + str(regs[{0}]) + ' out of range')\nif regs[{1}]:\n    bits[regs[{0}] >> 3] |= 1 << (regs[{0}] & 7)\nelse:\n    bits[regs[{0}] >> 3] &= ~(1 << (regs[{0}] & 7))",
+    DIVMODI: "regs[{0}], regs[{1}] = divmod(regs[{2}], {3})",
+    XOFF: "if regs[{1}] <= 0:\n    machine.error('xoff_op', 'step ' + str(regs[{1}]) + ' is not positive')\nif regs[{0}] < 0 or regs[{2}] < 0:\n    machine.error('xoff_op', 'negative address ' + str(min(regs[{0}], regs[{2}])))\nif regs[{2}] > len(bits) << 3:\n    machine.error('xoff_op', 'address ' + str(regs[{2}]) + ' out of range')\nfor addr in range(regs[{0}], regs[{2}], regs[{1}]):\n    bits[addr >> 3] &= ~(1 << (addr & 7))",
+}
+
+
+def compile_prog(program):
+    # partially evaluates the interpreter over a loaded program: every basic block
+    # becomes straight-line python in a single generated function, selected by a
+    # binary search on pc, so op codes are decoded once here instead of on every
+    # step of run(). The pc is kept in a local, which is why Machine.load() rejects
+    # PC as a register operand
+    leaders = {0}
+    for addr, instruct in enumerate(program):
+        if instruct[0] in BRANCHES:
+            leaders.add(addr + 1)
+            pos = BRANCHES[instruct[0]]
+            if pos is not None and instruct[pos] is not None:
+                leaders.add(instruct[pos])
+    leaders = sorted(l for l in leaders if l < len(program))
+
+    blocks = []
+    for i, start in enumerate(leaders):
+        end = leaders[i + 1] if i + 1 < len(leaders) else len(program)
+        body = []
+        for addr in range(start, end):
+            op, *args = program[addr]
+            if op == JMP:
+                body.append("pc = {}".format(args[0]))
+            elif op == JMPC:
+                body.append("pc = {} if cond else {}".format(addr + 1, args[0]))
+            elif op == JMPR:
+                body.append("ra = {}".format(addr + 1))
+                body.append("pc = {}".format(args[0]))
+            elif op == RET:
+                body.append("pc = ra")
+            elif op == LOOP:
+                body.append("regs[R_CNT] -= 1")
+                body.append("pc = {} if regs[R_CNT] else {}".format(args[0], addr + 1))
+            elif op == HALT:
+                body.append("pc = {}".format(addr))
+                body.append("break")
+            elif op == PRINT_STACK_LOOP:
+                body.append("if sp == 0:")
+                body.append("    machine.error('print_stack_loop', 'stack underflow')")
+                body.append("sp -= 1")
+                body.append("if stack[sp]:")
+                body.append("    out_append(chr(stack[sp]))")
+                body.append("else:")
+                body.append("    flush('\\n')")
+                body.append("regs[R_CNT] -= 1")
+                body.append("pc = {} if regs[R_CNT] else {}".format(args[0], addr + 1))
+            else:
+                body.extend(SOURCE[op].format(*args).split("\n"))
+        if program[end - 1][0] not in BRANCHES:
+            body.append("pc = {}".format(end))
+        blocks.append((start, body))
 
-# This code is for performing Eratosthenes' sieve to find all primes less than MAX_NUM and print them in their hexadecimal format
+    lines = [
+        "def _run(machine):",
+        "    regs = machine.regs",
+        "    mem = machine.mem",
+        "    bits = machine.bits",
+        "    out_append = machine.out.append",
+        "    flush = machine.flush",
+        "    stack = machine.stack",
+        "    sp = machine.sp",
+        "    cond = machine.cond",
+        "    ra = machine.ra",
+        "    pc = regs[PC]",
+        "    try:",
+        "        while True:",
+    ]
+
+    def emit(lo, hi, indent):
+        # blocks[lo:hi] are the candidates for the current pc
+        if hi - lo == 1:
+            lines.extend(indent + line for line in blocks[lo][1])
+            return
+        mid = (lo + hi) // 2
+        lines.append(indent + "if pc < {}:".format(blocks[mid][0]))
+        emit(lo, mid, indent + "    ")
+        lines.append(indent + "else:")
+        emit(mid, hi, indent + "    ")
+
+    emit(0, len(blocks), "            ")
+    # like run(), write the state back and flush output even if the program fails
+    lines.append("    finally:")
+    lines.append("        regs[PC] = pc")
+    lines.append("        machine.sp = sp")
+    lines.append("        machine.cond = cond")
+    lines.append("        machine.ra = ra")
+    lines.append("        flush()")
+    lines.append("    return 0")
+
+    namespace = {"PC": PC, "R_CNT": R_CNT}
+    exec("\n".join(lines), namespace)
+    return namespace["_run"]
+
+
+# This code is for performing Eratosthenes' sieve to find all primes less than MAX_NUM and print them in their hexadecimal format.
+# The primes below SIEVE_ROOT are found with the classic sieve and recorded in a list at PRIMES, then the rest of the range is
+# sieved in segments of SEG_SIZE flags stored at SEG_BASE, so crossing off multiples of each prime stays within one small block.
+# All flags are kept in the bit-packed flag memory (BLOAD/BSTOR) and the list of primes in data memory
 MAX_NUM = 1000
+SIEVE_ROOT = int(MAX_NUM ** 0.5) + 1 # every prime whose square is below MAX_NUM is below SIEVE_ROOT
+SEG_SIZE = 32768 # numbers sieved per segment
+PRIMES = 0 # data memory address of the list of primes below SIEVE_ROOT
+SEG_BASE = SIEVE_ROOT + 1 # flag memory address of the current segment's flags
 prog = [
-    (CNT, MAX_NUM), # 0 looping NUM_PRIMES times to initialize array of integers in memory
+    (CNT, SIEVE_ROOT), # 0 looping SIEVE_ROOT times to initialize array of integers in memory
     (LIMM, R_0, 1), # 1 initializing all values to true
-    (MEM, R_CNT, R_0, STOR), # 2 initializing NUM_PRIMES places in memory to store primes
+    (MEM, R_CNT, R_0, BSTOR), # 2 initializing SIEVE_ROOT places in memory to store primes
     (LOOP, 1), # 3
 
-    (LIMM, R_0, MAX_NUM), # 4 using R_0 to hold max value
+    (LIMM, R_0, SIEVE_ROOT), # 4 using R_0 to hold max value
     (LIMM, R_1, 1), # 5 i = 1
     (LIMM, R_2, 0), # 6 comparing to 0
+    (LIMM, R_10, PRIMES), # 7 R_10 points one past the last recorded prime
     # i-loop
-    (INC, R_1), # 7 increment i
-    (COMP, R_1, R_0, LT), # 8 while i < MAX_NUM
-    (JMPC, None), # 9
-    (MEM, R_3, R_1, LOAD), # 10 load boolean value at i into R_3
-    (COMP, R_2, R_3, NEQ), # 11 
-    (JMPC, 7), # 12 array boolean was false, skip to next iteration
-    (STCK, R_1, PUSH), # 13 pushing i onto stack
-    (JMPR, 24), # 14 calling hex function
-    (MATH, R_4, R_1, R_1, MULT), # 15 j = i^2
-    (COMP, R_4, R_0, LT), # 16 is j > MAX_NUM?
-    (JMPC, 7), # 17 go back to i-loop
-    (MEM, R_4, R_2, STOR), # 18 storing false
-    # j-loop
-    (MATH, R_4, R_4, R_1, ADD), # 19 incrementing j by i
-    (COMP, R_4, R_0, LT), # 20 checking if j > MAX_NUM
-    (JMPC, 7), # 21 back to i-loop
-    (MEM, R_4, R_2, STOR), # 22 storing false
-    (JMP, 18), # 23 go back to j-loop
+    (INC, R_1), # 8 increment i
+    (COMP, R_1, R_0, LT), # 9 while i < SIEVE_ROOT
+    (JMPC, 21), # 10 done with small primes, go sieve the segments
+    (MEM, R_3, R_1, BLOAD), # 11 load boolean value at i into R_3
+    (COMP, R_2, R_3, NEQ), # 12
+    (JMPC, 8), # 13 array boolean was false, skip to next iteration
+    (MEM, R_10, R_1, STOR), # 14 recording i in the list of primes
+    (INC, R_10), # 15
+    (STCK, R_1, PUSH), # 16 pushing i onto stack
+    (JMPR, 70), # 17 calling hex function
+    (MATH, R_4, R_1, R_1, MULT), # 18 j = i^2
+    (XOFF, R_4, R_1, R_0), # 19 crossing off j, j + i, ... below SIEVE_ROOT
+    (JMP, 8), # 20 go back to i-loop
+
+    (LIMM, R_0, MAX_NUM), # 21 using R_0 to hold max value
+    (LIMM, R_11, SIEVE_ROOT), # 22 R_11(lo) = first number of the segment
+    # segment-loop
+    (COMP, R_11, R_0, LT), # 23 while lo < MAX_NUM
+    (JMPC, None), # 24
+    (MOV, R_3, R_11), # 25
+    (MATHI, R_3, ADD, SEG_SIZE), # 26 R_3(hi) = lo + SEG_SIZE
+    (COMP, R_0, R_3, LT), # 27 if hi > MAX_NUM
+    (JMPC, 30), # 28
+    (MOV, R_3, R_0), # 29 clamp hi to MAX_NUM
+    (MATH, R_12, R_3, R_11, SUB), # 30 R_12(end) = hi - lo
+    (MATHI, R_12, ADD, SEG_BASE), # 31 plus SEG_BASE for the address one past the segment's flags
+    (LIMM, R_3, 1), # 32 initializing all flags to true
+    (LIMM, R_4, SEG_BASE), # 33 R_4 = address of the first flag
+    # fill-loop
+    (MEM, R_4, R_3, BSTOR), # 34 storing true
+    (INC, R_4), # 35
+    (COMP, R_4, R_12, LT), # 36 while address < end
+    (JMPC, 39), # 37
+    (JMP, 34), # 38
+    (LIMM, R_13, PRIMES), # 39 R_13 points at the first recorded prime
+    # prime-loop
+    (COMP, R_13, R_10, LT), # 40 while primes are left
+    (JMPC, 56), # 41 all crossed off, go print the segment
+    (MEM, R_1, R_13, LOAD), # 42 R_1(p) = next prime
+    (INC, R_13), # 43
+    (MATH, R_4, R_11, R_1, ADD), # 44 j = lo + p
+    (MATHI, R_4, SUB, 1), # 45 j = lo + p - 1
+    (MATH, R_4, R_4, R_1, DIV), # 46
+    (MATH, R_4, R_4, R_1, MULT), # 47 j = first multiple of p not below lo
+    (MATH, R_3, R_1, R_1, MULT), # 48 R_3 = p^2
+    (COMP, R_4, R_3, LT), # 49 if j < p^2
+    (JMPC, 52), # 50
+    (MOV, R_4, R_3), # 51 start crossing off at p^2 instead
+    (MATH, R_4, R_4, R_11, SUB), # 52 turning j into an address in the segment
+    (MATHI, R_4, ADD, SEG_BASE), # 53
+    (XOFF, R_4, R_1, R_12), # 54 crossing off j, j + p, ... up to the end of the segment
+    (JMP, 40), # 55 go back to prime-loop
+
+    (MOV, R_1, R_11), # 56 R_1(n) = lo
+    (LIMM, R_4, SEG_BASE), # 57 R_4 = address of n's flag
+    # scan-loop
+    (MEM, R_3, R_4, BLOAD), # 58 load boolean value of n into R_3
+    (COMP, R_2, R_3, NEQ), # 59
+    (JMPC, 63), # 60 n was crossed off, skip it
+    (STCK, R_1, PUSH), # 61 pushing n onto stack
+    (JMPR, 70), # 62 calling hex function
+    (INC, R_1), # 63 next n
+    (INC, R_4), # 64
+    (COMP, R_4, R_12, LT), # 65 while address < end
+    (JMPC, 68), # 66
+    (JMP, 58), # 67
+    (MATHI, R_11, ADD, SEG_SIZE), # 68 lo += SEG_SIZE
+    (JMP, 23), # 69 back to segment-loop
     # convert to hex
-    (LIMM, R_5, 10), # 24 loading R_5 with 10 for comparison operations
-    (LIMM, R_CNT, 0), # 25 loading R_CNT with 0 for recording how many chars to print
-    (LIMM, R_6, 16), # 26 loading R_6 with 16 for divisor
+    (LIMM, R_5, 10), # 70 loading R_5 with 10 for comparison operations
+    (LIMM, R_CNT, 0), # 71 loading R_CNT with 0 for recording how many chars to print
     # hex-loop
-    (STCK, R_7, POP), # 27 popping value to convert off stack into R_7
-    (MATH, R_8, R_7, R_6, DIV), # 28 R_8(quotient) = num / 16
-    (MATH, R_9, R_8, R_6, MULT), # 29 R_9(temp) = quotient * divisor
-    (MATH, R_9, R_7, R_9, SUB), # 30 R_9(remainder) = R_6 - R_8
-    (COMP, R_9, R_5, LT), # 31 if remainder > 10
-    (JMPC, 35), # 32 skip to 35
-    (MATHI, R_9, ADD, 48), # 33 else add 48 to remainder for correct ASCII value
-    (JMP, 36), # 34 and continue
-    (MATHI, R_9, ADD, 55), # 35 add 55 to remainder for correct ASCII value
-    (STCK, R_9, PUSH), # 36 push value to stack
-    (INC, R_CNT), # 37 increment count
-    (COMP, R_8, R_2, NEQ), # 38 if quotient == 0
-    (JMPC, 42), # 39 we're done, time to print
-    (STCK, R_8, PUSH), # 40 else push quotient to stack for loop
-    (JMP, 27), # 41 back to hex-loop
-    (STCK, R_9, POP), # 42 pop top value into R_9
-    (MEM, 0xffff0001, R_9, STOR), # 43 string printer of value at R_9
-    (LOOP, 42), # 44 loop back to 41
-    (LIMM, R_9, 0), # 45 load ASCII value of null
-    (MEM, 0xffff0001, R_9, STOR), # 46 print null character and cause newline
+    (STCK, R_7, POP), # 72 popping value to convert off stack into R_7
+    (DIVMODI, R_8, R_9, R_7, 16), # 73 R_8(quotient), R_9(remainder) = num / 16, num % 16
+    (COMP, R_9, R_5, LT), # 74 if remainder > 10
+    (JMPC, 78), # 75 skip to 78
+    (MATHI, R_9, ADD, 48), # 76 else add 48 to remainder for correct ASCII value
+    (JMP, 79), # 77 and continue
+    (MATHI, R_9, ADD, 55), # 78 add 55 to remainder for correct ASCII value
+    (STCK, R_9, PUSH), # 79 push value to stack
+    (INC, R_CNT), # 80 increment count
+    (COMP, R_8, R_2, NEQ), # 81 if quotient == 0
+    (JMPC, 85), # 82 we're done, time to print
+    (STCK, R_8, PUSH), # 83 else push quotient to stack for loop
+    (JMP, 72), # 84 back to hex-loop
+    (PRINT_STACK_LOOP, 85), # 85 popping and printing R_CNT characters off the stack
+    (LIMM, R_9, 0), # 86 load ASCII value of null
+    (MEM, IO_CHAR, R_9, STOR), # 87 print null character and cause newline
     (RET,)
 ]
 